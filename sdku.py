@@ -2,6 +2,7 @@ import pygame as pg
 from pygame.locals import *
 import random as rd
 import copy
+import collections
 import time
 import datetime
 
@@ -31,6 +32,7 @@ class Case:
         self.is_selected = False     # Used for display
         self.is_wrong = False        # Contains a wrong value
         self.blacklist = []          # Numbers that can't be used
+        self.blacklist_reasons = {}  # Choice levels responsible for them
 
     def set(self, value=None):
         """
@@ -81,11 +83,15 @@ class Case:
 
 class Sudoku:
 
-    def __init__(self):
+    def __init__(self, max_nogoods=1000):
         self.grid = []                     # Matrix of cases
         self.set_history = []              # Whole history of value setting
         self.choice_history = []           # History of choices
         self.minimum_possibilities = None  # Minimum of cases list value length
+        self.reasons = {}                  # Choice levels each value relies on
+        self.nogoods = collections.OrderedDict()  # Learned wrong choice sets
+        self.max_nogoods = max_nogoods     # Size of the nogood cache
+        self.blacklist_levels = {}         # Blacklisted numbers per level
 
         for i in range(9):
             self.grid.append([])
@@ -104,6 +110,7 @@ class Sudoku:
         """
         if record:
             self.set_history.append((i, j, value))
+        self.reasons.pop((i, j), None)
         self.grid[i][j].set(value)
         if lock:
             self.grid[i][j].is_locked = True
@@ -183,41 +190,191 @@ class Sudoku:
             for j in range(9):
                 if isinstance(self.get_value(i, j), type([]))\
                         and len(self.get_value(i, j)) == 1:
-                    self.set_case(i, j, self.grid[i][j].value[0])
+                    value = self.grid[i][j].value[0]
+                    reason = frozenset()
+                    for (q, eliminated) in self.elimination_reasons(i, j)\
+                            .items():
+                        if q != value:
+                            reason |= eliminated
+                    self.set_case(i, j, value)
+                    self.reasons[(i, j)] = reason
 
-    def backtrack(self, verbosity=False):
+    def get_reason(self, i, j):
         """
-        Remove last choice, adds it to the case blacklist, and removes all
-        changes since then (resetting cases).
+        :param i: Row of the case
+        :param j: Column of the case
+        :return: The set of choice levels the value of the case relies on.
+        Empty for givens.
+        """
+        return self.reasons.get((i, j), frozenset())
+
+    def elimination_reasons(self, i, j):
+        """
+        Explains why each number can't be used in a case, either because of
+        its blacklist, or because a relative already contains it. The
+        explanation relying on the earliest choices is preferred, to jump
+        further back.
+        :param i: Row of the case
+        :param j: Column of the case
+        :return: Dictionary of the set of choice levels responsible for the
+        elimination of each number. Numbers that are not eliminated rely on
+        every choice.
+        """
+        reasons = {}
+        for q in self.grid[i][j].blacklist:
+            reasons[q] = self.grid[i][j].blacklist_reasons[q]
+        for (k, p) in get_relatives(i, j):
+            q = self.get_value(k, p)
+            if isinstance(q, type(0)):
+                reason = self.get_reason(k, p)
+                if q not in reasons or max(reason, default=-1)\
+                        < max(reasons[q], default=-1):
+                    reasons[q] = reason
+        every_choice = frozenset(range(len(self.choice_history)))
+        return {q: reasons.get(q, every_choice) for q in range(1, 10)}
+
+    def find_conflict(self):
+        """
+        Looks for contradictions in the grid: two relatives with the same
+        value, or a case without any possibility. If there are several, the
+        one relying on the earliest choices is returned, to jump further back.
+        :return: The set of choice levels responsible for the contradiction
+        """
+        conflicts = []
+        for i in range(9):
+            for j in range(9):
+                if self.case_error(i, j):
+                    for (k, p) in get_relatives(i, j):
+                        if self.get_value(k, p) == self.get_value(i, j):
+                            conflicts.append(self.get_reason(i, j)
+                                             | self.get_reason(k, p))
+                elif not isinstance(self.get_value(i, j), type(0))\
+                        and len(self.get_possibilities(i, j)) == 0:
+                    conflict = frozenset()
+                    for reason in self.elimination_reasons(i, j).values():
+                        conflict |= reason
+                    conflicts.append(conflict)
+        if len(conflicts) == 0:
+            return frozenset(range(len(self.choice_history)))
+        return min(conflicts, key=lambda conflict: max(conflict, default=-1))
+
+    def learn_nogood(self, choices):
+        """
+        Stores a set of choices that can't be made together, dropping the
+        least recently used one if the cache is full.
+        :param choices: List of (i, j, value) choices
+        :return: void
+        """
+        nogood = frozenset(choices)
+        if nogood in self.nogoods:
+            self.nogoods.move_to_end(nogood)
+            return
+        self.nogoods[nogood] = None
+        if len(self.nogoods) > self.max_nogoods:
+            self.nogoods.popitem(last=False)
+
+    def apply_nogoods(self):
+        """
+        For each learned nogood that holds but for one value, blacklists that
+        value in its case, if empty. Also looks for nogoods that fully hold.
+        :return: The set of choice levels responsible for a nogood that fully
+        holds, or None
+        """
+        used = []
+        conflict = None
+        for nogood in self.nogoods:
+            remaining = []
+            for (i, j, q) in nogood:
+                if self.get_value(i, j) != q:
+                    remaining.append((i, j, q))
+                    if len(remaining) > 1:
+                        break
+            if len(remaining) > 1:
+                continue
+            reason = frozenset()
+            for (i, j, q) in nogood:
+                if (i, j, q) not in remaining:
+                    reason |= self.get_reason(i, j)
+            if len(remaining) == 0:
+                used.append(nogood)
+                conflict = reason
+                break
+            i, j, q = remaining[0]
+            if not isinstance(self.get_value(i, j), type(0))\
+                    and q not in self.grid[i][j].blacklist:
+                used.append(nogood)
+                self.add_blacklist(i, j, q, reason)
+        for nogood in used:
+            self.nogoods.move_to_end(nogood)
+        return conflict
+
+    def add_blacklist(self, i, j, q, reason):
+        """
+        Blacklists a number in a case, and indexes it by the latest choice it
+        relies on, to remove it when backtracking over that choice.
+        :param i: Row of the case
+        :param j: Column of the case
+        :param q: Blacklisted number
+        :param reason: Set of choice levels responsible for it
+        :return: void
+        """
+        self.grid[i][j].blacklist.append(q)
+        self.grid[i][j].blacklist_reasons[q] = reason
+        if len(reason) > 0:
+            self.blacklist_levels.setdefault(max(reason), []).append((i, j, q))
+
+    def backtrack(self, verbosity=False, conflict=None):
+        """
+        Jumps back to the latest choice responsible for the conflict, adds it
+        to the case blacklist, and removes all changes since then (resetting
+        cases). Blacklisted numbers only relying on earlier choices are kept.
+        The responsible choices are learned as a nogood.
         :param verbosity: Display print message
+        :param conflict: Set of choice levels responsible for the error. If
+        None, jumps back to the last choice, and nothing is learned.
         :return: void
         """
-        i0, j0, error_value = self.choice_history.pop()
+        if conflict is None:
+            conflict = frozenset(range(len(self.choice_history)))
+        elif len(conflict) > 0:
+            self.learn_nogood([self.choice_history[k] for k in conflict])
+        if len(conflict) == 0:
+            raise Exception("No choice left to backtrack")
+        level = max(conflict)
+        i0, j0, error_value = self.choice_history[level]
         if verbosity:
-            print("WRONG CHOICE: ", i0, j0, error_value)
-        self.grid[i0][j0].blacklist.append(error_value)
+            print("WRONG CHOICE: ", i0, j0, error_value, "(jumped over",
+                  len(self.choice_history) - level - 1, "choices)")
+        del self.choice_history[level:]
         run = True
         while run:
             i, j, value = self.set_history.pop()
             self.set_case(i, j, None, record=False)
             if (i, j) == (i0, j0):
                 run = False
-            else:
-                self.grid[i][j].blacklist = []
+        for k in [k for k in self.blacklist_levels if k >= level]:
+            for (i, j, q) in self.blacklist_levels.pop(k):
+                self.grid[i][j].blacklist.remove(q)
+                del self.grid[i][j].blacklist_reasons[q]
+        self.add_blacklist(i0, j0, error_value, conflict - {level})
 
     def step_solve(self, verbosity=False):
         """
-        Set all posibilities.
-        If an error is detected, then backtracks.
+        Apply learned nogoods and set all posibilities.
+        If an error is detected, then backjumps to its cause.
         If at least one case has 1 possibility, set all values.
         Else, finds a case with least possible possibilities in the grid, and
         choose one of its values.
         :param verbosity: Display print messages
         :return: void
         """
-        self.set_possibilities()
-        if self.is_wrong() or self.minimum_possibilities <= 0:
-            self.backtrack()
+        conflict = self.apply_nogoods()
+        if conflict is None:
+            self.set_possibilities()
+            if self.is_wrong() or self.minimum_possibilities <= 0:
+                conflict = self.find_conflict()
+        if conflict is not None:
+            self.backtrack(verbosity, conflict)
         elif self.minimum_possibilities == 1:
             self.set_sure_values()
         elif self.minimum_possibilities > 1:
@@ -235,15 +392,14 @@ class Sudoku:
                         run = False
                     j += 1
                 i += 1
-            # Choosing its value, and appends it to blacklist to avoid it being
-            # selected later on.
+            # Choosing its value. Backtracking will add it to the blacklist.
             possibilities = self.get_possibilities(i0, j0)
             k = rd.randint(0, len(possibilities)-1)
             if verbosity:
                 print("CHOICE: ", i0, j0, possibilities[k])
             self.choice_history.append((i0, j0, possibilities[k]))
             self.set_case(i0, j0, possibilities[k])
-            self.grid[i0][j0].blacklist.append(possibilities[k])
+            self.reasons[(i0, j0)] = frozenset([len(self.choice_history) - 1])
 
     def solve(self, verbosity=True, display=None):
         """
@@ -421,6 +577,128 @@ class DisplaySudoku:
         pg.display.flip()
 
 
+class SudokuBank:
+
+    def __init__(self, seeds=5):
+        self.puzzles = []   # List of (matrix of givens, metadata)
+        self.seeds = seeds  # Number of seeded solves to measure difficulty
+
+    def add(self, sudoku, verbosity=False):
+        """
+        Checks that the sudoku has exactly one solution, and stores its givens
+        along with its metadata: its number of givens, and its difficulty as
+        measured by measure_steps.
+        :param sudoku: The Sudoku to add
+        :param verbosity: Display print message
+        :return: Wether the sudoku has been added
+        """
+        m = matrix_from_givens(sudoku)
+        reference = sudoku_from_matrix(m)
+        if not reference.solve(verbosity=False) \
+                or copy.deepcopy(reference).second_solve(verbosity=False):
+            if verbosity:
+                print("Sudoku rejected: solution is not unique.")
+            return False
+        metadata = {
+            "givens": 81 - len([None for row in m for value in row
+                                if value is None]),
+            "steps": self.measure_steps(m)
+        }
+        self.puzzles.append((m, metadata))
+        if verbosity:
+            print("Sudoku added to the bank: " + str(metadata["givens"])
+                  + " givens, " + str(metadata["steps"]) + " steps.")
+        return True
+
+    def measure_steps(self, m):
+        """
+        Measures the difficulty of the puzzles served from a stored one, as
+        the number of calls to step_solve needed to solve them. The solver
+        depends on the order of cases and the labels of numbers, so the count
+        is averaged over transformed variants, seeded from 0 to seeds - 1.
+        The result only depends on the puzzle, and the global random state is
+        restored afterwards.
+        :param m: Matrix of givens of a puzzle with a solution
+        :return: The average number of steps, rounded
+        """
+        state = rd.getstate()
+        steps = 0
+        for seed in range(self.seeds):
+            rd.seed(seed)
+            s = sudoku_from_matrix(transform_matrix(m))
+            while not s.is_solved():
+                s.step_solve()
+                steps += 1
+        rd.setstate(state)
+        return round(steps / self.seeds)
+
+    def fill(self, size, verbosity=True):
+        """
+        Generates new sudokus until the bank contains the given number of
+        puzzles. This is slow, and meant to be done once, before serving.
+        :param size: Wanted number of puzzles in the bank
+        :param verbosity: Display print message
+        :return: void
+        """
+        while len(self.puzzles) < size:
+            self.add(generate_sudoku(verbosity), verbosity)
+
+    def draw(self, min_givens=0, max_givens=81, min_steps=0,
+             max_steps=None):
+        """
+        Picks a random puzzle from the bank, and applies a random validity
+        preserving transformation to it. The result has a unique solution and
+        the same number of givens as the original puzzle.
+        :param min_givens: Minimum number of givens of the puzzle
+        :param max_givens: Maximum number of givens of the puzzle
+        :param min_steps: Minimum difficulty of the puzzle, in average steps
+        :param max_steps: Maximum difficulty of the puzzle, in average steps,
+        if any
+        :return: A new Sudoku, or None if no puzzle matches
+        """
+        candidates = [m for (m, metadata) in self.puzzles
+                      if min_givens <= metadata["givens"] <= max_givens
+                      and min_steps <= metadata["steps"]
+                      and (max_steps is None
+                           or metadata["steps"] <= max_steps)]
+        if len(candidates) == 0:
+            return None
+        return sudoku_from_matrix(transform_matrix(rd.choice(candidates)))
+
+    def save(self, filename):
+        """
+        Writes the bank to a file. Each puzzle is preceded by a line with its
+        metadata, and uses the same syntax as the string input.
+        :param filename: Path of the file
+        :return: void
+        """
+        file = open(filename, 'w')
+        for (m, metadata) in self.puzzles:
+            file.write("# givens=" + str(metadata["givens"])
+                       + " steps=" + str(metadata["steps"]) + "\n")
+            file.write(string_from_matrix(m))
+        file.close()
+
+    def load(self, filename):
+        """
+        Reads puzzles written by save, without verifying them again.
+        :param filename: Path of the file
+        :return: void
+        """
+        file = open(filename, 'r')
+        lines = file.read().split('\n')
+        file.close()
+        k = 0
+        while k + 9 < len(lines):
+            metadata = {}
+            for field in lines[k][1:].split():
+                key, value = field.split('=')
+                metadata[key] = int(value)
+            m = matrix_from_string('\n'.join(lines[k + 1:k + 10]))
+            self.puzzles.append((m, metadata))
+            k += 10
+
+
 def matrix_from_string(string):
     matrix = []
     for row in string.split('\n'):
@@ -463,12 +741,52 @@ def matrix_from_sudoku(s):
     return m
 
 
+def matrix_from_givens(s):
+    m = []
+    for i in range(9):
+        m.append([])
+        for j in range(9):
+            if s.grid[i][j].is_locked:
+                m[i].append(s.grid[i][j].value)
+            else:
+                m[i].append(None)
+    return m
+
+
+def transform_matrix(m):
+    """
+    Applies a random transformation that preserves the validity and the
+    uniqueness of the solution: digit relabeling, band and stack swaps, row
+    and column permutations within bands and stacks, and transposition.
+    :param m: Matrix of a sudoku
+    :return: A new transformed matrix
+    """
+
+    def random_lines():
+        bands = rd.sample(range(3), 3)
+        return [3 * band + k for band in bands for k in rd.sample(range(3), 3)]
+
+    labels = [None] + rd.sample(range(1, 10), 9)
+    rows, columns = random_lines(), random_lines()
+    transpose = rd.random() < .5
+    t = get_empty_matrix()
+    for i in range(9):
+        for j in range(9):
+            if transpose:
+                value = m[columns[j]][rows[i]]
+            else:
+                value = m[rows[i]][columns[j]]
+            if value is not None:
+                t[i][j] = labels[value]
+    return t
+
+
 def get_clicked_case(pos):
     x, y = pos
     return y // case_size, x // case_size
 
 
-def get_relatives(i, j):
+def compute_relatives(i, j):
 
     def get_row(i):
         return [(i, k) for k in range(9)]
@@ -481,8 +799,15 @@ def get_relatives(i, j):
                 for p in range(9)
                 if i//3 == k//3 and j//3 == p//3]
 
-    return [pos for pos in get_row(i) + get_square(i, j) + get_column(j)
-            if pos != (i, j)]
+    return sorted(set(pos for pos in get_row(i) + get_square(i, j)
+                      + get_column(j) if pos != (i, j)))
+
+
+RELATIVES = [[compute_relatives(i, j) for j in range(9)] for i in range(9)]
+
+
+def get_relatives(i, j):
+    return RELATIVES[i][j]
 
 
 def get_empty_matrix():
@@ -607,6 +932,8 @@ libe = "1  94 768\n" \
 #                   screen, case_size)
 
 s = DisplaySudoku(generate_long_sudoku(), screen, case_size)
+bank = SudokuBank()
+bank.add(s.sudoku)
 
 run = True
 while run:
@@ -635,6 +962,12 @@ while run:
                           + str(s.sudoku.case_error(i, j)))
             elif event.key == K_f:
                 s.sudoku.second_solve()
+            elif event.key == K_n:
+                drawn = bank.draw()
+                if drawn is None:
+                    print("The bank is empty.")
+                else:
+                    s = DisplaySudoku(drawn, screen, case_size)
             elif event.key == K_g:
                 filename = "sudoku_" + datetime.datetime\
                     .fromtimestamp(time.time())\